@@ -1,13 +1,23 @@
 import gradio as gr
-from openai import OpenAI
+from openai import AsyncOpenAI
+import httpx
+import asyncio
 import os
 import time
 import html
 import re
+import tempfile
+import threading
 import base64
+import functools
+import hashlib
+import importlib.util
+import json
 import mimetypes
+import mmap
 from datetime import datetime
-from typing import List, Tuple, Optional
+from types import MappingProxyType
+from typing import Iterator, List, Tuple, Optional
 from PIL import Image
 import io
 
@@ -36,28 +46,77 @@ MODEL_ID = 'Qwen/Qwen3-235B-A22B-Instruct-2507'
 MAX_MESSAGE_LENGTH = int(os.environ.get("MAX_MESSAGE_LENGTH", 16000))  # 限制单条消息长度
 MAX_HISTORY_LENGTH = int(os.environ.get("MAX_HISTORY_LENGTH", 50))     # 限制对话历史长度
 RATE_LIMIT_DELAY = int(os.environ.get("RATE_LIMIT_DELAY", 1))          # 请求间隔（秒）
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 60))         # 允许突发的请求数
+RATE_LIMIT_MAX_WAIT = int(os.environ.get("RATE_LIMIT_MAX_WAIT", 10))   # 排队等待的最长时间（秒）
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 10))  # 同时进行的API请求数
+QUEUE_CONCURRENCY_LIMIT = int(os.environ.get("QUEUE_CONCURRENCY_LIMIT", 20))  # Gradio 队列默认并发数
+QUEUE_MAX_SIZE = int(os.environ.get("QUEUE_MAX_SIZE", 100))                   # Gradio 队列最大排队数
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB 文件大小限制
 
 # API 限制配置 - 支持环境变量覆盖
 MAX_OUTPUT_TOKENS = int(os.environ.get("MAX_OUTPUT_TOKENS", 32000))      # API最大输出token数 (32K)
 DEFAULT_OUTPUT_TOKENS = int(os.environ.get("DEFAULT_OUTPUT_TOKENS", 8000))  # 默认输出token数 (8K)
+CONTEXT_WINDOW = int(os.environ.get("CONTEXT_WINDOW", 131072))             # 模型上下文窗口token数 (128K)
+
+# 响应缓存配置 - 支持环境变量覆盖
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "./cache")         # 缓存目录
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 86400))         # 缓存有效期（秒）
+CACHE_MAX_TEMPERATURE = 1.0      # 温度高于此值时回答过于随机，不做缓存
+CACHE_REPLAY_CHUNK_SIZE = 50     # 缓存命中时按块回放，保留打字效果
+
+# 流式输出合并配置 - 积累一定字符数或时间后再刷新 UI，减少前端更新次数
+STREAM_BUFFER_SIZE = 40          # 缓冲字符数达到此值时刷新
+STREAM_FLUSH_INTERVAL = 0.025    # 距上次刷新超过此时间（秒）时刷新
 
 # 支持的文件类型
-SUPPORTED_TEXT_EXTENSIONS = {'.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv'}
-SUPPORTED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+SUPPORTED_TEXT_EXTENSIONS = frozenset({'.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv'})
+SUPPORTED_IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'})
 
-# 初始化 OpenAI 客户端
+# 初始化异步 OpenAI 客户端（流式读取不阻塞事件循环）
+# 使用共享连接池复用 TCP/TLS 连接；安装 h2 后启用 HTTP/2，多个会话的流共用同一连接
 try:
-    client = OpenAI(
+    http_client = httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+        timeout=httpx.Timeout(connect=5, read=300, write=10, pool=5),
+    )
+    client = AsyncOpenAI(
         base_url=BASE_URL,
         api_key=API_KEY,
+        http_client=http_client,
     )
 except Exception as e:
     print(f"Error initializing OpenAI client: {e}")
     client = None
 
+# 初始化响应缓存（未安装 diskcache 时禁用缓存）
+try:
+    import diskcache
+    response_cache = diskcache.Cache(RESPONSE_CACHE_DIR)
+except ImportError:
+    response_cache = None
+except Exception as e:
+    print(f"Error initializing response cache: {e}")
+    response_cache = None
+
 # --- 文件处理函数 ---
 
+def read_text_file(file_path: str) -> str:
+    """
+    读取文本文件
+    
+    通过 mmap 直接从页缓存解码，省去先读出 bytes 再解码的一次拷贝；
+    CPython 的 UTF-8 解码器本身对 ASCII 内容有快速路径，无需额外检查。
+    """
+    with open(file_path, 'rb') as f:
+        # 空文件无法建立 mmap
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content = str(mm, 'utf-8', 'ignore')
+    # 与文本模式 open() 的通用换行一致，统一为 \n
+    return content.replace('\r\n', '\n').replace('\r', '\n')
+
 def process_uploaded_file(file_path: str) -> Tuple[str, str]:
     """
     处理上传的文件
@@ -79,8 +138,7 @@ def process_uploaded_file(file_path: str) -> Tuple[str, str]:
     try:
         # 处理文本文件
         if file_ext in SUPPORTED_TEXT_EXTENSIONS:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            content = read_text_file(file_path)
             
             file_info = f"📄 文件: {file_name} ({file_size} bytes)"
             return content, file_info
@@ -88,19 +146,20 @@ def process_uploaded_file(file_path: str) -> Tuple[str, str]:
         # 处理图片文件
         elif file_ext in SUPPORTED_IMAGE_EXTENSIONS:
             # 读取并压缩图片
+            max_size = (800, 800)
             with Image.open(file_path) as img:
                 # 转换为RGB（如果需要）
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
                 
                 # 调整大小（保持比例）
-                max_size = (800, 800)
                 img.thumbnail(max_size, Image.Resampling.LANCZOS)
                 
                 # 转换为base64
                 buffer = io.BytesIO()
-                img.save(buffer, format='JPEG', quality=85)
-                img_base64 = base64.b64encode(buffer.getvalue()).decode()
+                img.save(buffer, format='JPEG', quality=85, optimize=True, progressive=True)
+                # 直接编码内存视图，省去 getvalue() 的一次拷贝
+                img_base64 = base64.b64encode(buffer.getbuffer()).decode()
             
             file_info = f"🖼️ 图片: {file_name} ({img.size[0]}x{img.size[1]})"
             # 返回base64编码的图片数据，用于API调用
@@ -112,9 +171,16 @@ def process_uploaded_file(file_path: str) -> Tuple[str, str]:
     except Exception as e:
         return "", f"文件处理失败: {str(e)[:100]}"
 
+# 按整秒缓存格式化后的时间戳：[秒数, 字符串]
+_timestamp_cache = [0, ""]
+
 def get_timestamp() -> str:
-    """获取当前时间戳"""
-    return datetime.now().strftime("%H:%M:%S")
+    """获取当前时间戳（同一秒内复用格式化结果）"""
+    second = int(time.time())
+    if second != _timestamp_cache[0]:
+        _timestamp_cache[0] = second
+        _timestamp_cache[1] = time.strftime("%H:%M:%S", time.localtime(second))
+    return _timestamp_cache[1]
 
 def format_message_with_timestamp(content: str, role: str) -> str:
     """为消息添加时间戳"""
@@ -124,19 +190,26 @@ def format_message_with_timestamp(content: str, role: str) -> str:
     else:
         return f"**[{timestamp}] AI:** {content}"
 
-def export_conversation(history: List[dict]) -> str:
-    """导出对话历史为文本格式"""
+# 导出文件存放在临时目录中，进程退出时自动删除
+export_dir = tempfile.TemporaryDirectory(prefix="qwen3_gradio_exports_")
+
+# 导出时去掉时间戳的加粗标记：**[12:00:00] 您:** -> [12:00:00] 您:
+_EXPORT_TS_PATTERN = re.compile(r"\*\*\[(.*?)\] (您|AI):\*\*")
+# 消息开头的时间戳前缀：**[12:00:00] AI:**
+_TS_PREFIX_PATTERN = re.compile(r"^\*\*\[\d\d:\d\d:\d\d\] (?:您|AI):\*\*\s*")
+
+def export_conversation_iter(history: List[dict]) -> Iterator[str]:
+    """逐段生成对话历史的导出文本，可直接写入文件而无需拼接整个字符串"""
     if not history:
-        return "暂无对话记录"
+        yield "暂无对话记录"
+        return
     
-    export_text = f"# 对话记录导出\n导出时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+    yield f"# 对话记录导出\n导出时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
     
     for msg in history:
         role = "用户" if msg["role"] == "user" else "AI助手"
-        content = msg["content"].replace("**[", "[").replace("] 您:**", "] 您:").replace("] AI:**", "] AI:")
-        export_text += f"## {role}\n{content}\n\n"
-    
-    return export_text
+        content = _EXPORT_TS_PATTERN.sub(r"[\1] \2:", msg["content"])
+        yield f"## {role}\n{content}\n\n"
 
 def handle_export(history: List[dict]):
     """处理对话导出"""
@@ -144,14 +217,20 @@ def handle_export(history: List[dict]):
         return None, show_notification("暂无对话记录可导出", "warning")
     
     try:
-        export_content = export_conversation(history)
-        filename = f"conversation_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        
-        # 创建临时文件
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(export_content)
+        # 每次导出创建唯一的临时文件，避免多个用户同时导出时互相覆盖，边生成边写入
+        with tempfile.NamedTemporaryFile(
+            mode='w',
+            buffering=1 << 16,
+            encoding='utf-8',
+            prefix=f"conversation_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}_",
+            suffix='.txt',
+            dir=export_dir.name,
+            delete=False,
+        ) as f:
+            f.writelines(export_conversation_iter(history))
         
-        return filename, show_notification(f"对话已成功导出到 {filename}", "success")
+        filename = os.path.basename(f.name)
+        return f.name, show_notification(f"对话已成功导出到 {filename}", "success")
     except Exception as e:
         return None, show_notification(f"导出失败: {str(e)[:50]}", "error")
 
@@ -164,9 +243,7 @@ def copy_last_response(history: List[dict]):
     for msg in reversed(history):
         if msg["role"] == "assistant" and msg["content"].strip():
             # 移除时间戳格式
-            content = msg["content"]
-            if content.startswith("**[") and "] AI:**" in content:
-                content = content.split("] AI:**", 1)[1].strip()
+            content = _TS_PREFIX_PATTERN.sub("", msg["content"], count=1).strip()
             
             # 在实际应用中，这里可以使用JavaScript来复制到剪贴板
             # 现在只是显示状态信息
@@ -174,10 +251,12 @@ def copy_last_response(history: List[dict]):
     
     return "⚠️ 未找到AI回复"
 
+# 通知图标（只读映射，模块加载时创建一次）
+_NOTIFICATION_ICONS = MappingProxyType({"success": "✅", "error": "❌", "info": "ℹ️", "warning": "⚠️"})
+
 def show_notification(message: str, msg_type: str = "info"):
     """显示通知消息"""
-    icons = {"success": "✅", "error": "❌", "info": "ℹ️", "warning": "⚠️"}
-    icon = icons.get(msg_type, "ℹ️")
+    icon = _NOTIFICATION_ICONS.get(msg_type, "ℹ️")
     return f"{icon} {message}"
 
 def get_api_info():
@@ -189,6 +268,7 @@ def get_api_info():
     - 默认输出tokens: {DEFAULT_OUTPUT_TOKENS}
     - 最大消息长度: {MAX_MESSAGE_LENGTH} 字符
     - 对话历史限制: {MAX_HISTORY_LENGTH} 条
+    - 上下文窗口: {CONTEXT_WINDOW} tokens（最大输出不超过其一半）
     
     💡 **Token说明:**
     - 1 token ≈ 0.75个中文字符 或 1个英文单词的一部分
@@ -198,6 +278,25 @@ def get_api_info():
 
 # --- 安全工具函数 ---
 
+# 按文本做缓存的长度上限：单条消息上限加上时间戳前缀和截断标记
+_MEMO_MAX_TEXT_LENGTH = MAX_MESSAGE_LENGTH + 64
+
+def _memoize_short_text(func):
+    """
+    按文本缓存函数结果。超长文本（如包含上传文件内容的消息）直接计算、不做缓存，
+    避免其作为缓存键长期占用进程内存
+    """
+    cached = functools.lru_cache(maxsize=1024)(func)
+
+    @functools.wraps(func)
+    def wrapper(text: str):
+        if len(text) > _MEMO_MAX_TEXT_LENGTH:
+            return func(text)
+        return cached(text)
+
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
 def sanitize_input(text: str) -> str:
     """
     清理和验证用户输入
@@ -205,8 +304,15 @@ def sanitize_input(text: str) -> str:
     if not text or not isinstance(text, str):
         return ""
     
-    # 移除潜在的恶意字符
-    text = html.escape(text.strip())
+    return _escape_and_truncate(text)
+
+@_memoize_short_text
+def _escape_and_truncate(text: str) -> str:
+    """
+    转义并截断文本。历史消息每轮都会重新提交，缓存结果后只有新追加的消息需要真正处理
+    """
+    # 移除潜在的恶意字符（内容以 Markdown 渲染，不在属性中，无需转义引号）
+    text = html.escape(text.strip(), quote=False)
     
     # 限制长度
     if len(text) > MAX_MESSAGE_LENGTH:
@@ -214,6 +320,20 @@ def sanitize_input(text: str) -> str:
     
     return text
 
+def sanitize_history_content(text: str) -> str:
+    """
+    清理历史消息。历史内容在之前的轮次中已经转义过，先还原再转义，
+    避免 &amp; 每轮都被重复转义为 &amp;amp;
+    """
+    if not text or not isinstance(text, str):
+        return ""
+    
+    return _unescape_and_sanitize(text)
+
+@_memoize_short_text
+def _unescape_and_sanitize(text: str) -> str:
+    return _escape_and_truncate(html.unescape(text))
+
 def validate_history(history: List[dict]) -> List[dict]:
     """
     验证和清理对话历史
@@ -229,33 +349,191 @@ def validate_history(history: List[dict]) -> List[dict]:
     cleaned_history = []
     for item in history:
         if isinstance(item, dict) and "role" in item and "content" in item:
-            clean_content = sanitize_input(item["content"])
+            clean_content = sanitize_history_content(item["content"])
             if clean_content or item["role"] == "assistant":  # 保留所有助手消息和有效用户消息
                 cleaned_history.append({"role": item["role"], "content": clean_content})
     
     return cleaned_history
 
-# 简单的速率限制
-last_request_time = 0
+# --- 速率限制 ---
 
-def rate_limit_check() -> bool:
+class AsyncTokenBucket:
     """
-    检查速率限制
+    异步令牌桶速率限制器（进程内共享，不阻塞事件循环）
+    
+    平均每秒放行 rate 个请求，允许最多 capacity 个请求的突发。
     """
-    global last_request_time
-    current_time = time.time()
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate            # 每秒补充的令牌数
+        self.capacity = capacity    # 令牌桶容量
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待取得一个令牌
+        
+        Returns:
+            bool: 需要等待超过 timeout 秒时立即返回 False，否则取得令牌后返回 True
+        """
+        if self.rate <= 0:
+            return True
+        # 在锁内预约令牌（允许令牌数为负，表示已被排队的请求预约），不在锁内等待，
+        # 因此 timeout 包含了排在前面的所有请求所需的时间
+        async with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+            if timeout is not None and wait > timeout:
+                self._tokens += 1
+                return False
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # 等待期间被取消（用户关闭页面等），归还预约的令牌
+                async with self._lock:
+                    self._refill()
+                    self._tokens += 1
+                raise
+        return True
+
+rate_limiter = AsyncTokenBucket(
+    rate=1 / RATE_LIMIT_DELAY if RATE_LIMIT_DELAY > 0 else 0,
+    capacity=RATE_LIMIT_BURST,
+)
+# 限制同时进行的 API 请求数
+request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# --- 上下文长度控制 ---
+
+# tokenizer 在启动时由后台线程加载（首次加载需要下载 BPE 文件，可能很慢或失败），
+# 加载完成前以及加载失败时按字符数估算 token 数
+# cl100k_base 与 Qwen 的分词结果不完全相同，但足以估算上下文占用
+token_encoding = None
+TOKENIZER_LOAD_ATTEMPTS = 3      # 加载 tokenizer 的最大尝试次数
+TOKENIZER_RETRY_DELAY = 30       # 两次尝试之间的间隔（秒）
+
+def load_token_encoding():
+    """在后台加载 tokenizer，失败时重试，不会阻塞用户请求"""
+    global token_encoding
+    try:
+        import tiktoken
+    except ImportError:
+        print("tiktoken is not installed; estimating token counts from character counts")
+        return
     
-    if current_time - last_request_time < RATE_LIMIT_DELAY:
-        return False
+    for attempt in range(1, TOKENIZER_LOAD_ATTEMPTS + 1):
+        try:
+            token_encoding = tiktoken.get_encoding("cl100k_base")
+            # 丢弃加载前按字符数估算并缓存的结果
+            count_tokens.cache_clear()
+            return
+        except Exception as e:
+            print(f"Error loading tokenizer (attempt {attempt}/{TOKENIZER_LOAD_ATTEMPTS}): {e}")
+            if attempt < TOKENIZER_LOAD_ATTEMPTS:
+                time.sleep(TOKENIZER_RETRY_DELAY)
+    print("Tokenizer unavailable; estimating token counts from character counts")
+
+@_memoize_short_text
+def count_tokens(text: str) -> int:
+    """估算文本的 token 数。历史消息每轮都会重新计数，因此缓存结果"""
+    if token_encoding is None:
+        return len(text)
+    return len(token_encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> Tuple[str, int]:
+    """
+    按 token 边界截断文本
     
-    last_request_time = current_time
-    return True
+    Returns:
+        Tuple[str, int]: (截断后的文本, token 数)
+    """
+    if token_encoding is None:
+        if len(text) <= max_tokens:
+            return text, len(text)
+        return text[:max_tokens] + "...", max_tokens
+    
+    tokens = token_encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text, len(tokens)
+    return token_encoding.decode(tokens[:max_tokens]) + "...", max_tokens
+
+def fit_messages_to_context(api_messages: List[dict], max_tokens: int) -> Tuple[List[dict], int]:
+    """
+    裁剪发送给 API 的消息，使提示加上最大输出不超过上下文窗口
+    
+    最大输出不超过上下文窗口的一半，保证提示有足够空间；保留系统提示；
+    当前消息过长时按 token 边界截断；再从最早的历史开始成对丢弃。
+    
+    Returns:
+        Tuple[List[dict], int]: (裁剪后的消息, 调整后的最大输出 token 数)
+    """
+    max_tokens = min(max_tokens, CONTEXT_WINDOW // 2)
+    system_msg, history, current_msg = api_messages[0], api_messages[1:-1], api_messages[-1]
+    budget = CONTEXT_WINDOW - max_tokens - count_tokens(system_msg["content"])
+    if budget <= 0:
+        raise ValueError(f"CONTEXT_WINDOW ({CONTEXT_WINDOW}) 过小，无法容纳系统提示和回复")
+    
+    current_content, current_tokens = truncate_to_tokens(current_msg["content"], budget)
+    if current_content is not current_msg["content"]:
+        current_msg = {**current_msg, "content": current_content}
+    budget -= current_tokens
+    
+    counts = [count_tokens(msg["content"]) for msg in history]
+    total = sum(counts)
+    start = 0
+    while total > budget and start < len(history):
+        total -= counts[start]
+        start += 1
+        # 连同对应的回复一起丢弃，保证保留的历史从用户消息开始
+        while start < len(history) and history[start]["role"] != "user":
+            total -= counts[start]
+            start += 1
+    
+    return [system_msg, *history[start:], current_msg], max_tokens
+
+threading.Thread(target=load_token_encoding, name="tokenizer-loader", daemon=True).start()
+
+# --- 响应缓存 ---
+
+def build_cache_key(api_messages: List[dict], temperature: float, max_tokens: int) -> str:
+    """根据完整消息列表和采样参数生成缓存键"""
+    payload = json.dumps(
+        {"msgs": api_messages, "t": temperature, "max": max_tokens, "model": MODEL_ID},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.blake2b(payload.encode()).hexdigest()
+
+def is_cacheable(temperature: float) -> bool:
+    """判断当前请求是否可以使用响应缓存"""
+    return response_cache is not None and temperature <= CACHE_MAX_TEMPERATURE
 
 # --- Gradio 应用核心逻辑 ---
 
-def predict(message: str, history: List[dict], uploaded_file=None, temperature=0.7, max_tokens=DEFAULT_OUTPUT_TOKENS):
+async def predict(message: str, history: List[dict], uploaded_file=None, temperature=0.7, max_tokens=DEFAULT_OUTPUT_TOKENS):
+    """
+    事件处理函数：清空输入框并流式更新对话窗口。
+    
+    Yields:
+        Tuple: (输入框更新, 对话历史)。第一次返回空字符串清空输入框，之后不再修改输入框，
+               避免覆盖用户在回复生成期间输入的新内容。
+    """
+    textbox_update = ""
+    async for updated_history in stream_reply(message, history, uploaded_file, temperature, max_tokens):
+        yield textbox_update, updated_history
+        textbox_update = gr.update()
+
+async def stream_reply(message: str, history: List[dict], uploaded_file=None, temperature=0.7, max_tokens=DEFAULT_OUTPUT_TOKENS):
     """
-    核心预测函数，用于生成 AI 回复。
+    核心预测函数（异步生成器），用于生成 AI 回复。
     
     Args:
         message (str): 用户输入的最新消息。
@@ -270,16 +548,12 @@ def predict(message: str, history: List[dict], uploaded_file=None, temperature=0
         yield history + [{"role": "user", "content": message}, {"role": "assistant", "content": "错误：OpenAI 客户端未成功初始化。请检查 API 密钥和网络连接。"}]
         return
     
-    # 速率限制检查
-    if not rate_limit_check():
-        yield history + [{"role": "user", "content": message}, {"role": "assistant", "content": "请求过于频繁，请稍后再试。"}]
-        return
-    
     # 处理上传的文件
     file_content = ""
     file_info = ""
     if uploaded_file:
-        file_content, file_info = process_uploaded_file(uploaded_file.name)
+        # 文件读取和图片处理放到线程中执行，避免阻塞事件循环
+        file_content, file_info = await asyncio.to_thread(process_uploaded_file, uploaded_file.name)
         if file_info and not file_content and "失败" in file_info:
             yield history + [{"role": "user", "content": message}, {"role": "assistant", "content": f"文件处理错误: {file_info}"}]
             return
@@ -322,51 +596,112 @@ def predict(message: str, history: List[dict], uploaded_file=None, temperature=0
     # 添加当前用户消息
     api_messages.append({'role': 'user', 'content': clean_message})
 
-    # 2. 调用模型 API 并开启流式响应
-    try:
-        stream = client.chat.completions.create(
-            model=MODEL_ID,
-            messages=api_messages,
-            stream=True,
-            max_tokens=max_tokens,  # 用户可控制的响应长度
-            temperature=temperature,  # 用户可控制的随机性
-        )
-    except Exception as e:
-        error_msg = f"API 调用失败: {str(e)[:100]}..."  # 限制错误消息长度
-        yield clean_history + [{"role": "user", "content": clean_message}, {"role": "assistant", "content": error_msg}]
-        return
-
-    # 3. 处理流式响应并更新 UI
-    # 首先，将用户的消息添加到历史记录中，AI 的回复暂时为空
+    # 将用户的消息添加到历史记录中，AI 的回复暂时为空
+    # 之后的每次 yield 都返回同一个 clean_history 列表并原地修改最后一条消息，
+    # Gradio 据此只向前端发送变化的部分，而不是每个 token 都重传整个对话
     user_msg_with_timestamp = format_message_with_timestamp(clean_message, "user")
     clean_history.extend([
         {"role": "user", "content": user_msg_with_timestamp},
         {"role": "assistant", "content": ""}
     ])
-    
-    # 逐块接收和处理流式数据
-    bot_response = ""
+    # 立即显示用户消息（predict 借此清空输入框），不必等待限流、排队和模型首个 token
+    yield clean_history
+
+    # 按 token 数裁剪，避免超出上下文窗口
+    # 需要对整条消息（可能包含上传的大文件）分词，首次调用还会加载 tokenizer，放到线程中执行
     try:
-        for chunk in stream:
-            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                content = chunk.choices[0].delta.content
-                if content is not None:
-                    bot_response += content
-                    # 限制响应长度
-                    if len(bot_response) > MAX_MESSAGE_LENGTH:
-                        bot_response = bot_response[:MAX_MESSAGE_LENGTH] + "..."
-                        break
-                    
-                    # 更新历史记录中最后一条（也就是当前 AI）的回复
-                    ai_msg_with_timestamp = format_message_with_timestamp(bot_response, "assistant")
-                    clean_history[-1]["content"] = ai_msg_with_timestamp
-                    # 通过 yield 更新 Gradio Chatbot UI
-                    yield clean_history
-    except Exception as e:
-        error_msg = f"流式响应处理失败: {str(e)[:100]}..."
-        error_msg_with_timestamp = format_message_with_timestamp(error_msg, "assistant")
-        clean_history[-1]["content"] = error_msg_with_timestamp
+        api_messages, max_tokens = await asyncio.to_thread(fit_messages_to_context, api_messages, max_tokens)
+    except ValueError as e:
+        clean_history[-1]["content"] = f"配置错误: {e}"
         yield clean_history
+        return
+
+    # 命中缓存时直接回放，跳过 API 调用
+    cache_key = None
+    if is_cacheable(temperature):
+        cache_key = build_cache_key(api_messages, temperature, max_tokens)
+        # diskcache 读写涉及 SQLite 和文件 I/O，放到线程中执行
+        cached_response = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached_response is not None:
+            ai_prefix = format_message_with_timestamp("", "assistant")
+            for start in range(0, len(cached_response), CACHE_REPLAY_CHUNK_SIZE):
+                clean_history[-1]["content"] = ai_prefix + cached_response[:start + CACHE_REPLAY_CHUNK_SIZE]
+                yield clean_history
+            return
+
+    # 速率限制检查（缓存命中不占用配额）
+    if not await rate_limiter.acquire(timeout=RATE_LIMIT_MAX_WAIT):
+        clean_history[-1]["content"] = "请求过于频繁，请稍后再试。"
+        yield clean_history
+        return
+
+    # 2. 调用模型 API 并开启流式响应
+    async with request_semaphore:
+        try:
+            stream = await client.chat.completions.create(
+                model=MODEL_ID,
+                messages=api_messages,
+                stream=True,
+                max_tokens=max_tokens,  # 用户可控制的响应长度
+                temperature=temperature,  # 用户可控制的随机性
+            )
+        except Exception as e:
+            error_msg = f"API 调用失败: {str(e)[:100]}..."  # 限制错误消息长度
+            clean_history[-1]["content"] = error_msg
+            yield clean_history
+            return
+
+        # 3. 处理流式响应并更新 UI
+        # 逐块接收和处理流式数据
+        # 时间戳前缀只计算一次；回复内容以列表累积，只在刷新 UI 时拼接，长度用计数器跟踪
+        ai_prefix = format_message_with_timestamp("", "assistant")
+        response_chunks = []
+        response_len = 0
+        # 合并多个小块后再刷新 UI
+        pending_chars = 0
+        last_flush = time.monotonic()
+        try:
+            async for chunk in stream:
+                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        response_chunks.append(content)
+                        response_len += len(content)
+                        pending_chars += len(content)
+                        # 限制响应长度
+                        if response_len > MAX_MESSAGE_LENGTH:
+                            break
+                        
+                        now = time.monotonic()
+                        if pending_chars >= STREAM_BUFFER_SIZE or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                            # 更新历史记录中最后一条（也就是当前 AI）的回复
+                            clean_history[-1]["content"] = ai_prefix + "".join(response_chunks)
+                            # 通过 yield 更新 Gradio Chatbot UI
+                            yield clean_history
+                            pending_chars = 0
+                            last_flush = now
+        except Exception as e:
+            error_msg = f"流式响应处理失败: {str(e)[:100]}..."
+            error_msg_with_timestamp = format_message_with_timestamp(error_msg, "assistant")
+            clean_history[-1]["content"] = error_msg_with_timestamp
+            yield clean_history
+            return
+        finally:
+            # 提前结束（超长截断、客户端断开）时关闭 HTTP 流，停止服务端继续生成并归还连接
+            await stream.close()
+
+        bot_response = "".join(response_chunks)
+        if response_len > MAX_MESSAGE_LENGTH:
+            bot_response = bot_response[:MAX_MESSAGE_LENGTH] + "..."
+
+        # 刷新缓冲区中剩余的内容
+        if pending_chars:
+            clean_history[-1]["content"] = ai_prefix + bot_response
+            yield clean_history
+
+        # 4. 流式响应成功完成后写入缓存
+        if cache_key and bot_response:
+            await asyncio.to_thread(response_cache.set, cache_key, bot_response, expire=RESPONSE_CACHE_TTL)
 
 # --- Gradio UI 界面构建 ---
 
@@ -517,11 +852,15 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
 
     # --- 事件绑定 ---
     
-    # 绑定“发送”按钮的点击事件
-    submit_btn.click(predict, [msg_textbox, chatbot, file_upload, temperature_slider, max_tokens_slider], chatbot)
-    
-    # 绑定文本框的回车事件
-    msg_textbox.submit(predict, [msg_textbox, chatbot, file_upload, temperature_slider, max_tokens_slider], chatbot)
+    # 绑定“发送”按钮的点击事件和文本框的回车事件
+    # predict 同时负责清空输入框，每次提交只需一次后端调用
+    gr.on(
+        triggers=[submit_btn.click, msg_textbox.submit],
+        fn=predict,
+        inputs=[msg_textbox, chatbot, file_upload, temperature_slider, max_tokens_slider],
+        outputs=[msg_textbox, chatbot],
+        concurrency_limit=MAX_CONCURRENT_REQUESTS,
+    )
     
     # 绑定导出按钮
     export_btn.click(
@@ -540,13 +879,14 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
     # 主题切换功能（简单实现）
     def toggle_theme():
         return "🌞 浅色主题" if "🌓" in theme_btn.value else "🌓 切换主题"
-    
-    # 清空文本框，为下一次输入做准备
-    submit_btn.click(lambda: "", None, msg_textbox)
-    msg_textbox.submit(lambda: "", None, msg_textbox)
 
 
 if __name__ == "__main__":
     # 启动 Gradio 应用
+    # 显式开启队列，允许多个会话的流式回复并发进行
     # share=True 会创建一个公开链接，方便分享
-    demo.launch(share=True)
+    demo.queue(
+        default_concurrency_limit=QUEUE_CONCURRENCY_LIMIT,
+        max_size=QUEUE_MAX_SIZE,
+        status_update_rate=1.0,
+    ).launch(share=True, server_name="0.0.0.0", max_threads=80)